@@ -1,40 +1,86 @@
 import os
-from fastapi import FastAPI, Depends, HTTPException, Security, status, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, Request, Security, status
+from fastapi.responses import StreamingResponse
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import datetime
+from functools import lru_cache
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+import hmac
 import threading
+import socket
+import time
+import asyncio
 import logging
+import re
 import unicodedata
+import orjson
 
 try:
     from sync_rne import main as sync_main
-    from rne_differ import load_state, save_state
+    from rne_differ import load_state, update_commune
 except ImportError:
     logging.warning("Le module sync_rne n'a pas pu être importé. Mode développement local possible.")
-    def sync_main():
+    def sync_main(insee_filter=None):
         pass
     def load_state():
         return {}
-    def save_state(state): pass
+    def update_commune(insee, mutator, default_commune=None): pass
 
+try:
+    import scraper
+except ImportError:
+    logging.warning("Le module scraper n'a pas pu être importé. L'endpoint de scraping sera indisponible.")
+    scraper = None
+
+try:
+    from fastapi_cache import FastAPICache
+    from fastapi_cache.backends.inmemory import InMemoryBackend
+    from fastapi_cache.decorator import cache
+except ImportError:
+    logging.warning("Le module fastapi-cache2 n'est pas installé. Les réponses de consultation ne seront pas mises en cache.")
+    FastAPICache = None
+    def cache(*args, **kwargs):
+        return lambda func: func
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Cache des réponses : uniquement avec Redis (partagé entre workers, TTL appliqué par le serveur).
+    # InMemoryBackend ne purge une entrée expirée que lorsqu'elle est relue ; or les clés changent
+    # à chaque écriture de l'état (state_key_builder) et les anciennes ne le sont jamais :
+    # sans Redis, le cache est désactivé (l'état et les index restent en mémoire, voir get_cached_state).
+    if FastAPICache is not None:
+        if redis_client is not None:
+            import redis.asyncio
+            from fastapi_cache.backends.redis import RedisBackend
+            FastAPICache.init(RedisBackend(redis.asyncio.from_url(
+                REDIS_URL, socket_timeout=REDIS_SOCKET_TIMEOUT, socket_connect_timeout=REDIS_SOCKET_TIMEOUT
+            )), prefix="rne")
+        else:
+            FastAPICache.init(InMemoryBackend(), prefix="rne", enable=False)
+    yield
+    _sync_executor.shutdown(wait=False)
 
 app = FastAPI(
     title="API RNE Élus",
     description="API pour déclencher et surveiller l'extraction des données du Répertoire National des Élus.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # --- SECURITE ---
 # Clé secrète d'accès à l'API (à remplacer en production par une variable d'environnement)
 API_KEY = os.getenv("RNE_API_KEY", "super-secret-key-carel-2026").strip()
 API_KEY_NAME = "X-API-Key"
+_API_KEY_BYTES = API_KEY.encode()
 
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=True)
 
-def get_api_key(api_key: str = Security(api_key_header)):
-    if api_key == API_KEY:
+async def get_api_key(api_key: str = Security(api_key_header)):
+    # Comparaison à temps constant : la durée ne révèle pas la longueur du préfixe correct
+    if hmac.compare_digest(api_key.encode(), _API_KEY_BYTES):
         return api_key
     raise HTTPException(
         status_code=status.HTTP_403_FORBIDDEN,
@@ -61,68 +107,155 @@ class BatchCiblesRequest(BaseModel):
     insee_codes: List[str] = Field(..., description="Liste des codes INSEE à analyser")
 
 # --- ETAT GLOBAL DE L'API ---
-# Variable globale et verrou pour thread-safety
+# Avec plusieurs workers uvicorn, l'état de synchronisation doit être commun aux processus :
+# si REDIS_URL est défini, le verrou d'admission et le statut sont stockés dans Redis.
+# Sinon, repli sur une variable globale protégée par un verrou (un seul processus).
+REDIS_URL = os.getenv("REDIS_URL")
+SYNC_LOCK_KEY = "rne:sync:lock"
+SYNC_STATUS_KEY = "rne:sync:status"
+SYNC_LOCK_TTL = 3600  # Filet de sécurité si un worker meurt en pleine synchronisation
+STATUS_MIRROR_TTL = 1.0
+REDIS_SOCKET_TIMEOUT = 2.0  # Un Redis lent ou injoignable échoue vite au lieu de bloquer les requêtes
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+redis_client = None
+if REDIS_URL:
+    try:
+        import redis
+        redis_client = redis.Redis.from_url(
+            REDIS_URL, decode_responses=True,
+            socket_timeout=REDIS_SOCKET_TIMEOUT, socket_connect_timeout=REDIS_SOCKET_TIMEOUT
+        )
+        # Suppression atomique du verrou, seulement s'il nous appartient encore (GET puis DEL côté serveur)
+        _release_lock_script = redis_client.register_script(
+            "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+        )
+    except ImportError:
+        logging.warning("REDIS_URL est défini mais le module redis n'est pas installé. Statut de synchronisation local au processus.")
+
+# Variable globale et verrou pour thread-safety (miroir du statut Redis lorsqu'il est utilisé)
 sync_status = {
     "is_running": False,
     "last_run": None,
     "last_status": "inconnu"
 }
 status_lock = threading.Lock()
+_status_mirror_expiry = 0.0
+
+def acquire_sync(label: str) -> bool:
+    """
+    Réserve l'unique créneau de synchronisation. Retourne False si une synchronisation est déjà en cours.
+    Appels Redis bloquants : depuis un endpoint async, passer par asyncio.to_thread.
+    """
+    if redis_client is not None:
+        if not redis_client.set(SYNC_LOCK_KEY, WORKER_ID, nx=True, ex=SYNC_LOCK_TTL):
+            return False
+        try:
+            redis_client.hset(SYNC_STATUS_KEY, "last_status", label)
+        except Exception:
+            # Aucune synchronisation ne sera lancée : le verrou ne doit pas rester pris jusqu'à son expiration
+            _release_lock_script(keys=[SYNC_LOCK_KEY], args=[WORKER_ID])
+            raise
+        return True
 
-def run_sync_task():
-    """Tâche de fond exécutant la synchronisation du RNE."""
     with status_lock:
         if sync_status["is_running"]:
-            return # Sécurité supplémentaire
+            return False
         sync_status["is_running"] = True
-        sync_status["last_status"] = "en cours"
-        
+        sync_status["last_status"] = label
+        return True
+
+def release_sync(last_status: str, success: bool):
+    """Libère le créneau de synchronisation et enregistre le résultat."""
+    fields = {"last_status": last_status}
+    if success:
+        fields["last_run"] = datetime.now().isoformat()
+
+    if redis_client is not None:
+        # Appelé depuis le finally des tâches de fond : une erreur Redis n'y serait jamais journalisée.
+        # Le verrou est libéré même si l'écriture du statut a échoué.
+        try:
+            redis_client.hset(SYNC_STATUS_KEY, mapping=fields)
+        except Exception as e:
+            logging.error(f"Impossible d'enregistrer le statut de synchronisation dans Redis: {e}")
+        try:
+            # On ne supprime que notre propre verrou (il a pu expirer et être repris par un autre worker)
+            _release_lock_script(keys=[SYNC_LOCK_KEY], args=[WORKER_ID])
+        except Exception as e:
+            logging.error(f"Impossible de libérer le verrou de synchronisation Redis (expiration dans {SYNC_LOCK_TTL}s): {e}")
+        return
+
+    with status_lock:
+        sync_status.update(fields)
+        sync_status["is_running"] = False
+
+def read_sync_status() -> dict:
+    """Retourne une copie du statut de synchronisation (relu depuis Redis au plus une fois par seconde)."""
+    global _status_mirror_expiry
+    if redis_client is None:
+        with status_lock:
+            return dict(sync_status)
+
+    now = time.monotonic()
+    with status_lock:
+        if now < _status_mirror_expiry:
+            return dict(sync_status)
+
+    pipe = redis_client.pipeline()
+    pipe.hgetall(SYNC_STATUS_KEY)
+    pipe.exists(SYNC_LOCK_KEY)
+    fields, running = pipe.execute()
+
+    with status_lock:
+        sync_status["is_running"] = bool(running)
+        sync_status["last_run"] = fields.get("last_run")
+        sync_status["last_status"] = fields.get("last_status", "inconnu")
+        _status_mirror_expiry = now + STATUS_MIRROR_TTL
+        return dict(sync_status)
+
+# Exécuteur dédié aux synchronisations : le travail lourd ne tourne jamais sur les workers qui servent les requêtes
+_sync_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rne-sync")
+
+def run_sync_task():
+    """Tâche de fond exécutant la synchronisation du RNE (le créneau est réservé par l'endpoint)."""
+    last_status = "erreur"
     try:
         logging.info("Démarrage de la tâche de synchronisation en arrière-plan...")
         sync_main()
-        
-        with status_lock:
-            sync_status["last_status"] = "succès"
-            sync_status["last_run"] = datetime.now().isoformat()
-            
+        last_status = "succès"
     except Exception as e:
         logging.error(f"Erreur critique dans la tâche de fond RNE: {e}")
-        with status_lock:
-            sync_status["last_status"] = "erreur"
     finally:
-        with status_lock:
-            sync_status["is_running"] = False
+        release_sync(last_status, success=last_status == "succès")
 
 # --- ENDPOINTS ---
 
 @app.post("/api/v1/sync", status_code=status.HTTP_202_ACCEPTED, tags=["Synchronisation"])
-def trigger_sync(background_tasks: BackgroundTasks, api_key: str = Depends(get_api_key)):
+async def trigger_sync(api_key: str = Depends(get_api_key)):
     """
     Déclenche le processus de synchronisation RNE.
     Exécute les tâches lourdes en arrière-plan pour ne pas bloquer l'appelant.
     Nécessite le header X-API-Key.
     """
-    with status_lock:
-        if sync_status["is_running"]:
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail="Une synchronisation est déjà en cours."
-            )
+    if not await asyncio.to_thread(acquire_sync, "en cours"):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Une synchronisation est déjà en cours."
+        )
             
-    background_tasks.add_task(run_sync_task)
+    _sync_executor.submit(run_sync_task)
     return {
         "message": "La tâche de synchronisation RNE a été démarrée en arrière-plan avec succès.",
         "status": "accepted"
     }
 
 @app.get("/api/v1/status", tags=["Supervision"])
-def get_status(api_key: str = Depends(get_api_key)):
+async def get_status(api_key: str = Depends(get_api_key)):
     """
     Vérifie l'état actuel du processus de synchronisation RNE.
     Nécessite le header X-API-Key.
     """
-    with status_lock:
-        current_status = dict(sync_status)
+    current_status = await asyncio.to_thread(read_sync_status)
         
     return {
         "status": "online",
@@ -130,18 +263,109 @@ def get_status(api_key: str = Depends(get_api_key)):
         "timestamp": datetime.now().isoformat()
     }
 
+# Diacritiques combinants produits par la décomposition NFD
+_COMBINING_RE = re.compile(r'[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]')
+
+@lru_cache(maxsize=65536)
 def normalize_string(input_str: str) -> str:
     """Retire les accents et passe en minuscules pour faciliter la recherche."""
-    return ''.join(c for c in unicodedata.normalize('NFD', input_str) if unicodedata.category(c) != 'Mn').lower().strip()
+    # Chemin rapide : une chaîne ASCII n'a aucun accent à retirer
+    if input_str.isascii():
+        return input_str.lower().strip()
+    return _COMBINING_RE.sub('', unicodedata.normalize('NFD', input_str)).lower().strip()
+
+# --- CACHE DE L'ETAT RNE ---
+# L'état n'est rechargé (et l'index par nom reconstruit) que si rne_state.json a changé sur le disque
+STATE_FILE = "rne_state.json"
+_state_cache = {"mtime": None, "data": None, "name_index": None}
+_state_cache_lock = threading.Lock()
+# Champs dérivés des élus, calculés à la première consultation d'une commune : insee -> (commune, entrées)
+_elus_index_cache = {}
+
+def _state_file_stamp():
+    try:
+        st = os.stat(STATE_FILE)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+def get_cached_state():
+    """
+    Retourne l'état RNE et l'index {nom de commune normalisé: code INSEE}.
+    Les deux sont conservés en mémoire tant que la date de modification du fichier ne change pas.
+    """
+    mtime = _state_file_stamp()
+    with _state_cache_lock:
+        if _state_cache["data"] is None or _state_cache["mtime"] != mtime:
+            data = load_state()
+            name_index = {}
+            for insee, commune in data.items():
+                # setdefault conserve la première commune rencontrée en cas d'homonymie
+                name_index.setdefault(normalize_string(commune.get("nom_commune", "")), insee)
+            _elus_index_cache.clear()
+            # mtime est écrit en dernier : get_state_async ne voit jamais un couple data/index incohérent
+            _state_cache["data"] = data
+            _state_cache["name_index"] = name_index
+            _state_cache["mtime"] = mtime
+        return _state_cache["data"], _state_cache["name_index"]
+
+async def get_state_async():
+    """
+    Variante pour les endpoints asynchrones : le cache est servi directement depuis la boucle
+    d'événements, seul un rechargement depuis le disque est délégué à un thread.
+    """
+    if _state_cache["data"] is not None and _state_cache["mtime"] == _state_file_stamp():
+        return _state_cache["data"], _state_cache["name_index"]
+    return await asyncio.to_thread(get_cached_state)
+
+def get_elus_index(insee: str, commune: dict) -> dict:
+    """
+    Retourne les champs dérivés des élus de la commune en colonnes parallèles (même position = même élu) :
+    elus, keys (NOM, prénom normalisé), postes_str (postes joints), postes_norm (postes joints normalisés),
+    et positions {(NOM, prénom normalisé): position du premier élu correspondant}.
+    Calculé une seule fois par version de la commune : toute écriture (update_commune)
+    remplace l'objet commune, ce qui invalide l'entrée.
+    """
+    cached = _elus_index_cache.get(insee)
+    if cached is not None and cached[0] is commune:
+        return cached[1]
+
+    elus = list(commune.get("elus", {}).values())
+    keys = [(e.get("nom", "").upper(), normalize_string(e.get("prenom", ""))) for e in elus]
+    postes_str = [" - ".join(e.get("postes", [])) for e in elus]
+    positions = {}
+    for pos, key in enumerate(keys):
+        # En cas d'homonymes, le premier élu rencontré l'emporte (comme l'ancien parcours linéaire)
+        positions.setdefault(key, pos)
+
+    index = {
+        "elus": elus,
+        "keys": keys,
+        "postes_str": postes_str,
+        "postes_norm": [normalize_string(p) for p in postes_str],
+        "positions": positions
+    }
+    _elus_index_cache[insee] = (commune, index)
+    return index
+
+def state_key_builder(func, namespace="", *, request=None, response=None, args=(), kwargs=None):
+    """
+    Clé de cache des réponses dérivées de l'état : inclut l'empreinte de rne_state.json,
+    les entrées sont donc invalidées d'elles-mêmes à chaque synchronisation ou scraping.
+    """
+    params = ":".join(f"{k}={v}" for k, v in sorted((kwargs or {}).items()) if k != "api_key")
+    # Comme le key_builder par défaut, on préfixe la clé (prefix="rne") pour ne pas partager l'espace Redis nu
+    return f"{FastAPICache.get_prefix()}:{namespace}:{func.__name__}:{params}:{_state_file_stamp()}"
 
 @app.get("/api/v1/commune/{identifiant}/elus", tags=["Consultation"])
-def get_commune_elus(identifiant: str, api_key: str = Depends(get_api_key)):
+@cache(expire=3600, key_builder=state_key_builder)
+async def get_commune_elus(identifiant: str, api_key: str = Depends(get_api_key)):
     """
     Récupère la liste des élus d'une commune spécifique depuis l'état RNE local.
     L'identifiant peut être un code INSEE ou le nom exact de la ville sans les accents.
     Nécessite le header X-API-Key.
     """
-    state_data = load_state()
+    state_data, name_index = await get_state_async()
     if not state_data:
          raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -159,12 +383,9 @@ def get_commune_elus(identifiant: str, api_key: str = Depends(get_api_key)):
     
     # 2. Recherche par nom exact corrigé si pas trouvé par INSEE
     if not commune_data:
-        search_term = normalize_string(identifiant)
-        for insee, data in state_data.items():
-            if normalize_string(data.get("nom_commune", "")) == search_term:
-                commune_data = data
-                commune_insee = insee
-                break
+        commune_insee = name_index.get(normalize_string(identifiant))
+        if commune_insee:
+            commune_data = state_data[commune_insee]
 
     if not commune_data:
         raise HTTPException(
@@ -174,7 +395,7 @@ def get_commune_elus(identifiant: str, api_key: str = Depends(get_api_key)):
 
     # 3. Formatage de la réponse
     elus_list = []
-    for elu_key, elu_info in commune_data.get("elus", {}).items():
+    for elu_info in commune_data.get("elus", {}).values():
         elus_list.append({
             "nom": elu_info.get("nom", ""),
             "prenom": elu_info.get("prenom", ""),
@@ -188,13 +409,17 @@ def get_commune_elus(identifiant: str, api_key: str = Depends(get_api_key)):
         "elus": elus_list
     }
 
+# Postes "cibles" (Maire, Adjoint...) : un seul appel C par poste au lieu de .lower() + deux recherches
+_CIBLE_RE = re.compile(r"maire|adjoint", re.IGNORECASE)
+
 @app.get("/api/v1/commune/{insee}/cibles", tags=["Filtrage Métier"])
-def get_commune_cibles(insee: str, api_key: str = Depends(get_api_key)):
+@cache(expire=3600, key_builder=state_key_builder)
+async def get_commune_cibles(insee: str, api_key: str = Depends(get_api_key)):
     """
     Filtre: Ne retourne OBLIGATOIREMENT que les élus dont le poste contient 'Maire' ou 'Adjoint'.
     Rôle: Réduire la taille du payload pour N8N.
     """
-    state_data = load_state()
+    state_data, _ = await get_state_async()
     if not state_data:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -210,9 +435,9 @@ def get_commune_cibles(insee: str, api_key: str = Depends(get_api_key)):
     commune_data = state_data[insee]
     cibles = []
     
-    for elu_key, elu_info in commune_data.get("elus", {}).items():
+    for elu_info in commune_data.get("elus", {}).values():
         postes = elu_info.get("postes", [])
-        is_cible = any("maire" in p.lower() or "adjoint" in p.lower() for p in postes)
+        is_cible = any(_CIBLE_RE.search(p) for p in postes)
         if is_cible:
             cibles.append({
                 "nom": elu_info.get("nom", ""),
@@ -228,12 +453,12 @@ def get_commune_cibles(insee: str, api_key: str = Depends(get_api_key)):
     }
 
 @app.post("/api/v1/communes/cibles/batch", tags=["Filtrage Métier"])
-def get_communes_cibles_batch(request: BatchCiblesRequest, api_key: str = Depends(get_api_key)):
+async def get_communes_cibles_batch(request: BatchCiblesRequest, api_key: str = Depends(get_api_key)):
     """
     Extrait par lot les élus cibles (Maire/Adjoint) pour une liste de codes INSEE.
     Retourne un objet JSON plat optimisé pour l'ingestion par N8N.
     """
-    state_data = load_state()
+    state_data, _ = await get_state_async()
     if not state_data:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -249,11 +474,11 @@ def get_communes_cibles_batch(request: BatchCiblesRequest, api_key: str = Depend
         commune_data = state_data[insee]
         commune_nom = commune_data.get("nom_commune", "")
         
-        for elu_key, elu_info in commune_data.get("elus", {}).items():
+        for elu_info in commune_data.get("elus", {}).values():
             postes = elu_info.get("postes", [])
             
             # Filtre Métier 80/20
-            cibles_postes = [p for p in postes if "maire" in p.lower() or "adjoint" in p.lower()]
+            cibles_postes = [p for p in postes if _CIBLE_RE.search(p)]
             
             if cibles_postes:
                 # Si l'élu a plusieurs postes qualifiants, on les rassemble
@@ -270,62 +495,109 @@ def get_communes_cibles_batch(request: BatchCiblesRequest, api_key: str = Depend
     return result_flat
 
 def run_batch_task(codes_insee: List[str]):
-    """Tâche de fond pour forcer la mise à jour d'un lot de codes INSEE."""
-    with status_lock:
-        if sync_status["is_running"]:
-            return
-        sync_status["is_running"] = True
-        sync_status["last_status"] = "en cours (batch)"
-        
+    """Tâche de fond pour forcer la mise à jour d'un lot de codes INSEE (le créneau est réservé par l'endpoint)."""
+    last_status = "erreur (batch)"
     try:
         logging.info(f"Démarrage de la synchro batch pour {len(codes_insee)} commune(s)...")
-        # En production, cela appellerait une fonction qui scrape/sync uniquement ces INSEEs
-        sync_main()
-        
-        with status_lock:
-            sync_status["last_status"] = "succès (batch)"
-            sync_status["last_run"] = datetime.now().isoformat()
+        sync_main(insee_filter=codes_insee)
+        last_status = "succès (batch)"
     except Exception as e:
         logging.error(f"Erreur critique batch: {e}")
-        with status_lock:
-            sync_status["last_status"] = "erreur (batch)"
     finally:
-        with status_lock:
-            sync_status["is_running"] = False
+        release_sync(last_status, success=last_status == "succès (batch)")
 
 @app.post("/api/v1/sync/batch", status_code=status.HTTP_202_ACCEPTED, tags=["Synchronisation"])
-def trigger_batch_sync(request: BatchSyncRequest, background_tasks: BackgroundTasks, api_key: str = Depends(get_api_key)):
+async def trigger_batch_sync(request: BatchSyncRequest, api_key: str = Depends(get_api_key)):
     """
-    Déclenche une tâche de fond (BackgroundTasks) qui va forcer la mise à jour RNE pour ces communes.
+    Déclenche une tâche de fond (exécuteur dédié) qui va forcer la mise à jour RNE pour ces communes.
     Permet de lisser la charge avec des envois par lots depuis N8N.
     """
-    with status_lock:
-        if sync_status["is_running"]:
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail="Une synchronisation est déjà en cours."
-            )
+    if not await asyncio.to_thread(acquire_sync, "en cours (batch)"):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Une synchronisation est déjà en cours."
+        )
             
-    background_tasks.add_task(run_batch_task, request.codes_insee)
+    _sync_executor.submit(run_batch_task, request.codes_insee)
     return {
         "message": f"Synchronisation batch démarrée pour {len(request.codes_insee)} codes INSEE.",
         "status": "accepted"
     }
 
+def _commune_upserts(insee: str, sf_list: List[SalesforceElu], commune: dict) -> list:
+    """Calcule les UPDATE/CREATE d'une commune entre les élus Salesforce et les élus locaux."""
+    upserts = []
+
+    # Clés (NOM, prénom normalisé) et postes joints des élus locaux : précalculés par get_elus_index
+    local = get_elus_index(insee, commune)
+    positions = local["positions"]
+    sf_entries = [((e.nom.upper(), normalize_string(e.prenom)), e) for e in sf_list]
+    sf_keys = {sf_key for sf_key, _ in sf_entries}
+    
+    # 1. Vérifier UPDATE
+    for sf_key, sf_elu in sf_entries:
+        pos = positions.get(sf_key)
+                
+        if pos is not None:
+            postes_locaux = local["postes_str"][pos]
+            if not sf_elu.fonction_actuelle or normalize_string(sf_elu.fonction_actuelle) != local["postes_norm"][pos]:
+                upserts.append({
+                    "id_salesforce": sf_elu.id_salesforce,
+                    "code_insee": insee,
+                    "nom": sf_elu.nom,
+                    "prenom": sf_elu.prenom,
+                    "nouvelle_fonction": postes_locaux,
+                    "action": "UPDATE"
+                })
+                
+    # 2. Vérifier CREATE (élus locaux absents de Salesforce)
+    for pos, local_key in enumerate(local["keys"]):
+        if local_key not in sf_keys:
+            elu_info = local["elus"][pos]
+            upserts.append({
+                "id_salesforce": None,
+                "code_insee": insee,
+                "nom": elu_info.get("nom", ""),
+                "prenom": elu_info.get("prenom", ""),
+                "nouvelle_fonction": local["postes_str"][pos],
+                "action": "CREATE"
+            })
+
+    return upserts
+
+async def _upserts_json_body(commune_upserts):
+    """Corps JSON {"upserts": [...]} émis commune par commune."""
+    yield b'{"upserts":['
+    first = True
+    for upserts in commune_upserts:
+        if not upserts:
+            continue
+        chunk = b",".join(orjson.dumps(u) for u in upserts)
+        yield chunk if first else b"," + chunk
+        first = False
+    yield b"]}"
+
+async def _upserts_ndjson_body(commune_upserts):
+    """Corps NDJSON : un upsert par ligne."""
+    for upserts in commune_upserts:
+        if upserts:
+            yield b"".join(orjson.dumps(u) + b"\n" for u in upserts)
+
 @app.post("/api/v1/compare/salesforce", tags=["Comparaison"])
-def compare_salesforce(elus_sf: List[SalesforceElu], api_key: str = Depends(get_api_key)):
+async def compare_salesforce(elus_sf: List[SalesforceElu], request: Request, api_key: str = Depends(get_api_key)):
     """
     Compare un lot d'élus Salesforce avec l'état local load_state().
     Retourne exclusivement les objets nécessitant une mise à jour ou une création.
+    La réponse est envoyée au fil de l'eau, commune par commune : {"upserts": [...]} par défaut,
+    ou un upsert par ligne si le client envoie "Accept: application/x-ndjson".
     """
-    state_data = load_state()
+    state_data, _ = await get_state_async()
     if not state_data:
          raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="La base RNE locale n'est pas chargée."
         )
 
-    upserts = []
     # Group input by code_insee for CREATE detection
     sf_by_insee = {}
     for sf_elu in elus_sf:
@@ -333,77 +605,49 @@ def compare_salesforce(elus_sf: List[SalesforceElu], api_key: str = Depends(get_
             sf_by_insee[sf_elu.code_insee] = []
         sf_by_insee[sf_elu.code_insee].append(sf_elu)
 
-    for insee, sf_list in sf_by_insee.items():
-        if insee not in state_data:
-            continue
-            
-        commune_elus = state_data[insee].get("elus", {})
-        
-        # 1. Vérifier UPDATE
-        for sf_elu in sf_list:
-            local_elu = None
-            for key, elu_info in commune_elus.items():
-                if elu_info.get("nom", "").upper() == sf_elu.nom.upper() and \
-                   normalize_string(elu_info.get("prenom", "")) == normalize_string(sf_elu.prenom):
-                    local_elu = elu_info
-                    break
-                    
-            if local_elu:
-                postes_locaux = " - ".join(local_elu.get("postes", []))
-                if not sf_elu.fonction_actuelle or normalize_string(sf_elu.fonction_actuelle) != normalize_string(postes_locaux):
-                    upserts.append({
-                        "id_salesforce": sf_elu.id_salesforce,
-                        "code_insee": insee,
-                        "nom": sf_elu.nom,
-                        "prenom": sf_elu.prenom,
-                        "nouvelle_fonction": postes_locaux,
-                        "action": "UPDATE"
-                    })
-                    
-        # 2. Vérifier CREATE (élus locaux absents de Salesforce)
-        sf_keys = [f"{e.nom.upper()}|{normalize_string(e.prenom)}" for e in sf_list]
-        for key, elu_info in commune_elus.items():
-            nom_local = elu_info.get("nom", "").upper()
-            prenom_local = normalize_string(elu_info.get("prenom", ""))
-            local_key = f"{nom_local}|{prenom_local}"
-            
-            if local_key not in sf_keys:
-                upserts.append({
-                    "id_salesforce": None,
-                    "code_insee": insee,
-                    "nom": elu_info.get("nom", ""),
-                    "prenom": elu_info.get("prenom", ""),
-                    "nouvelle_fonction": " - ".join(elu_info.get("postes", [])),
-                    "action": "CREATE"
-                })
+    commune_upserts = (
+        _commune_upserts(insee, sf_list, state_data[insee])
+        for insee, sf_list in sf_by_insee.items()
+        if insee in state_data
+    )
+
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        return StreamingResponse(_upserts_ndjson_body(commune_upserts), media_type="application/x-ndjson")
+    return StreamingResponse(_upserts_json_body(commune_upserts), media_type="application/json")
 
-    return {"upserts": upserts}
+def _scrape_lyon_flat():
+    """scrape_lyon regroupe les élus par subdivision : on les remet à plat."""
+    return [elu for elus in scraper.scrape_lyon().values() for elu in elus]
+
+# Mot-clé recherché dans l'URL -> fonction de scraping, par ordre de priorité
+_SCRAPERS = () if scraper is None else (
+    ("gignac", scraper.scrape_gignac),
+    ("toulouse", scraper.scrape_toulouse),
+    ("lyon", _scrape_lyon_flat),
+)
 
 @app.post("/api/v1/scrape/url", tags=["Scraping"])
 def scrape_url_endpoint(request: ScrapeRequest, api_key: str = Depends(get_api_key)):
     """
-    Importe et exécute les fonctions de scraper.py à la volée sur l'URL cible,
+    Exécute la fonction de scraper.py correspondant à l'URL cible,
     puis met à jour l'état local pour ce code INSEE précis.
     """
-    import scraper
-    
+    if scraper is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Le module de scraping est indisponible."
+        )
+
     url = request.url.lower()
-    scraped_data = []
+    scrape = next((func for keyword, func in _SCRAPERS if keyword in url), None)
+    if scrape is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="URL non supportée par les scripts de scraping."
+        )
     
     try:
-        if "gignac" in url:
-            scraped_data = scraper.scrape_gignac()
-        elif "toulouse" in url:
-            scraped_data = scraper.scrape_toulouse()
-        elif "lyon" in url:
-            lyon_data = scraper.scrape_lyon()
-            for arr_name, elus in lyon_data.items():
-                scraped_data.extend(elus)
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="URL non supportée par les scripts de scraping."
-            )
+        scraped_data = scrape()
             
         if not scraped_data:
             raise HTTPException(
@@ -411,35 +655,39 @@ def scrape_url_endpoint(request: ScrapeRequest, api_key: str = Depends(get_api_k
                 detail="Aucune donnée trouvée via l'URL spécifiée."
             )
             
-        # Mise à jour avec Lock
-        with status_lock:
-            state_data = load_state()
-            insee = request.code_insee
-            
-            if insee not in state_data:
-                state_data[insee] = {"nom_commune": "Commune Scrapée dynamiquement", "elus": {}}
-                
+        insee = request.code_insee
+
+        def merge_scraped(commune):
+            elus = commune["elus"]
+            # (NOM, prénom normalisé) -> clé du premier élu correspondant
+            matches = {}
+            for k, v in elus.items():
+                matches.setdefault((v.get("nom", "").upper(), normalize_string(v.get("prenom", ""))), k)
+
             for elu in scraped_data:
                 nom = elu.get("nom", "").upper()
                 prenom = elu.get("prenom", "")
                 poste = elu.get("poste", "")
                 
-                matched_key = None
-                for k, v in state_data[insee]["elus"].items():
-                    if v.get("nom", "").upper() == nom and normalize_string(v.get("prenom", "")) == normalize_string(prenom):
-                        matched_key = k
-                        break
+                match = (nom, normalize_string(prenom))
+                matched_key = matches.get(match)
                         
                 if not matched_key:
                     new_key = f"{nom}|{prenom}|Scraped"
-                    state_data[insee]["elus"][new_key] = {
+                    elus[new_key] = {
                         "nom": nom, "prenom": prenom, "postes": [poste] if poste else []
                     }
+                    matches[match] = new_key
                 else:
-                    if poste and poste not in state_data[insee]["elus"][matched_key]["postes"]:
-                        state_data[insee]["elus"][matched_key]["postes"].append(poste)
-                        
-            save_state(state_data)
+                    if poste and poste not in elus[matched_key]["postes"]:
+                        elus[matched_key]["postes"].append(poste)
+
+        # Seule la commune ciblée est copiée et modifiée, sous le verrou d'écriture de l'état
+        update_commune(
+            insee,
+            merge_scraped,
+            default_commune={"nom_commune": "Commune Scrapée dynamiquement", "elus": {}}
+        )
             
         return {
             "message": "Scraping réussi, état local mis à jour avec réactivité J+1.",
@@ -460,4 +708,18 @@ if __name__ == "__main__":
     import uvicorn
     # Affiche un rappel clair de la clé dans la console
     print(f"Démarrage de l'API. Clé d'accès exigée: {API_KEY}")
-    uvicorn.run("api:app", host="127.0.0.1", port=8000, reload=True)
+    # loop/http "auto" : uvicorn utilise uvloop et httptools dès qu'ils sont installés (voir requirements.txt).
+    # Plusieurs workers (RNE_WORKERS) ne partagent pas la mémoire Python : définir REDIS_URL pour que
+    # le verrou et le statut de synchronisation soient communs aux processus.
+    # En production : gunicorn api:app -k uvicorn.workers.UvicornWorker -w 4
+    dev_mode = bool(os.getenv("DEV"))
+    uvicorn.run(
+        "api:app",
+        host="127.0.0.1",
+        port=8000,
+        loop="auto",
+        http="auto",
+        # reload et workers sont incompatibles : un seul processus en mode développement
+        workers=1 if dev_mode else int(os.getenv("RNE_WORKERS", "1")),
+        reload=dev_mode
+    )
@@ -1,75 +1,248 @@
-import json
+import os
+import copy
+import hashlib
 import logging
+import threading
+from contextlib import contextmanager
+import orjson
 
-def compute_diff(old_state, new_state, insee_filter=None):
+try:
+    import fcntl
+except ImportError:
+    # Windows : pas de verrou entre processus, les écritures ne sont sûres qu'avec un seul worker
+    fcntl = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Cache des états déjà chargés : filepath -> ((mtime_ns, taille), état)
+_state_cache = {}
+# Cache des empreintes par commune : filepath -> ((mtime_ns, taille), {insee: hash})
+_hashes_cache = {}
+# Sérialise les écritures de l'état entre threads (réentrant : update_commune appelle save_state)
+_state_write_lock = threading.RLock()
+# Profondeur d'imbrication de _state_write_guard par fichier (modifiée uniquement sous _state_write_lock)
+_write_guard_depth = {}
+
+@contextmanager
+def _state_write_guard(filepath):
+    """
+    Verrou d'écriture de l'état, entre threads (RLock) et entre processus (flock sur
+    "<état>.lock") : avec plusieurs workers uvicorn, une lecture-modification-écriture
+    d'un worker ne peut plus écraser celle d'un autre. Réentrant dans un même thread.
+    """
+    with _state_write_lock:
+        depth = _write_guard_depth.get(filepath, 0)
+        lock_file = None
+        if depth == 0 and fcntl is not None:
+            lock_file = open(f"{filepath}.lock", "ab")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        _write_guard_depth[filepath] = depth + 1
+        try:
+            yield
+        finally:
+            _write_guard_depth[filepath] = depth
+            if lock_file is not None:
+                # La fermeture libère le verrou flock
+                lock_file.close()
+
+EMPTY_COMMUNE = {"nom_commune": "", "elus": {}}
+
+def _hashes_path(filepath):
+    """Fichier compagnon de l'état : empreinte de chaque commune."""
+    return f"{filepath}.hashes"
+
+def commune_hash(commune):
+    """Empreinte 64 bits du contenu d'une commune (JSON canonique, clés triées)."""
+    data = orjson.dumps(commune, option=orjson.OPT_SORT_KEYS)
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(data)
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+def compute_hashes(state):
+    """Empreintes {insee: hash} de toutes les communes d'un état."""
+    return {insee: commune_hash(commune) for insee, commune in state.items()}
+
+def _diff_commune(insee, old_c, new_c):
+    """Compare une commune entre deux états. Retourne l'entrée du rapport, ou None si rien n'a changé."""
+    nom_commune = new_c.get("nom_commune") or old_c.get("nom_commune")
+    
+    old_elus = old_c.get("elus", {})
+    new_elus = new_c.get("elus", {})
+    
+    changements = []
+    
+    for elu_key in new_elus.keys() - old_elus.keys():
+        new = new_elus[elu_key]
+        changements.append({
+            "elu": f"{new['prenom']} {new['nom']}",
+            "commune": nom_commune,
+            "type_changement": "NOUVEL_ELU",
+            "anciens_postes": [],
+            "nouveaux_postes": new["postes"]
+        })
+        
+    for elu_key in old_elus.keys() - new_elus.keys():
+        old = old_elus[elu_key]
+        changements.append({
+            "elu": f"{old['prenom']} {old['nom']}",
+            "commune": nom_commune,
+            "type_changement": "ELU_SORTANT",
+            "anciens_postes": old["postes"],
+            "nouveaux_postes": []
+        })
+        
+    for elu_key in old_elus.keys() & new_elus.keys():
+        old_postes = old_elus[elu_key]["postes"]
+        new = new_elus[elu_key]
+        new_postes = new["postes"]
+        # Cas le plus fréquent : listes identiques, aucun set à construire
+        if old_postes == new_postes:
+            continue
+        old_p = set(old_postes)
+        new_p = set(new_postes)
+        if old_p != new_p:
+            changements.append({
+                "elu": f"{new['prenom']} {new['nom']}",
+                "commune": nom_commune,
+                "type_changement": "MODIFICATION_POSTE",
+                "anciens_postes": sorted(old_p),
+                "nouveaux_postes": sorted(new_p)
+            })
+                
+    if not changements:
+        return None
+    return {
+        "commune_code_insee": insee,
+        "commune_nom": nom_commune,
+        "changements": changements
+    }
+
+def compute_diff(old_state, new_state, insee_filter=None, old_hashes=None, new_hashes=None):
     """
     Compare deux états de la base RNE et sort un tableau de changements.
     insee_filter: list de codes INSEE pour restreindre le diff (ex: ["13043", "31555", "69123"]). 
     Si None, compare toutes les communes.
+    old_hashes / new_hashes: empreintes des deux états (compute_hashes). Si elles sont fournies,
+    une commune dont l'empreinte n'a pas changé est ignorée sans parcourir ses élus.
     """
     diff_report = []
     
-    insee_codes = set(old_state.keys()).union(new_state.keys())
+    insee_codes = old_state.keys() | new_state.keys()
     if insee_filter:
-        insee_codes = insee_codes.intersection(insee_filter)
+        insee_codes &= set(insee_filter)
         
+    if old_hashes is not None and new_hashes is not None:
+        insee_codes = [insee for insee in insee_codes if old_hashes.get(insee) != new_hashes.get(insee)]
+
     for insee in insee_codes:
-        old_c = old_state.get(insee, {"nom_commune": "", "elus": {}})
-        new_c = new_state.get(insee, {"nom_commune": "", "elus": {}})
-        
-        nom_commune = new_c.get("nom_commune") or old_c.get("nom_commune")
-        
-        old_elus = old_c.get("elus", {})
-        new_elus = new_c.get("elus", {})
-        
-        changements = []
-        elu_keys = set(old_elus.keys()).union(new_elus.keys())
-        
-        for elu_key in elu_keys:
-            if elu_key not in old_elus:
-                changements.append({
-                    "elu": f"{new_elus[elu_key]['prenom']} {new_elus[elu_key]['nom']}",
-                    "commune": nom_commune,
-                    "type_changement": "NOUVEL_ELU",
-                    "anciens_postes": [],
-                    "nouveaux_postes": new_elus[elu_key]["postes"]
-                })
-            elif elu_key not in new_elus:
-                changements.append({
-                    "elu": f"{old_elus[elu_key]['prenom']} {old_elus[elu_key]['nom']}",
-                    "commune": nom_commune,
-                    "type_changement": "ELU_SORTANT",
-                    "anciens_postes": old_elus[elu_key]["postes"],
-                    "nouveaux_postes": []
-                })
-            else:
-                old_p = set(old_elus[elu_key]["postes"])
-                new_p = set(new_elus[elu_key]["postes"])
-                if old_p != new_p:
-                    changements.append({
-                        "elu": f"{new_elus[elu_key]['prenom']} {new_elus[elu_key]['nom']}",
-                        "commune": nom_commune,
-                        "type_changement": "MODIFICATION_POSTE",
-                        "anciens_postes": sorted(list(old_p)),
-                        "nouveaux_postes": sorted(list(new_p))
-                    })
-                    
-        if changements:
-            diff_report.append({
-                "commune_code_insee": insee,
-                "commune_nom": nom_commune,
-                "changements": changements
-            })
+        entry = _diff_commune(insee, old_state.get(insee, EMPTY_COMMUNE), new_state.get(insee, EMPTY_COMMUNE))
+        if entry:
+            diff_report.append(entry)
             
     return diff_report
 
-def save_state(state, filepath="rne_state.json"):
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+def _file_stamp(filepath):
+    st = os.stat(filepath)
+    return (st.st_mtime_ns, st.st_size)
+
+def _write_atomic(filepath, data):
+    tmp_path = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, filepath)
+
+def save_state(state, filepath="rne_state.json", hashes=None):
+    """
+    Écrit l'état de façon atomique (fichier temporaire puis os.replace) : un lecteur,
+    dans ce processus ou un autre worker, ne voit jamais un fichier à moitié écrit.
+    Les empreintes des communes (hashes, calculées si absentes) sont écrites à côté.
+    """
+    if hashes is None:
+        hashes = compute_hashes(state)
+    with _state_write_guard(filepath):
+        _write_atomic(filepath, orjson.dumps(state, option=orjson.OPT_INDENT_2))
+        stamp = _file_stamp(filepath)
+        # L'horodatage de l'état accompagne les empreintes : un état modifié par ailleurs les invalide
+        _write_atomic(_hashes_path(filepath), orjson.dumps({"stamp": stamp, "hashes": hashes}))
+        # L'état vient d'être écrit : inutile de le relire au prochain load_state
+        _state_cache[filepath] = (stamp, state)
+        _hashes_cache[filepath] = (stamp, hashes)
+
+def load_hashes(filepath="rne_state.json"):
+    """
+    Empreintes des communes de l'état sauvegardé. Lues dans le fichier compagnon s'il
+    correspond à l'état actuel, sinon recalculées depuis l'état.
+    L'objet retourné est partagé entre les appelants : ne pas le modifier en place.
+    """
+    if not os.path.exists(filepath):
+        return {}
+    stamp = _file_stamp(filepath)
+    cached = _hashes_cache.get(filepath)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    hashes = None
+    try:
+        with open(_hashes_path(filepath), "rb") as f:
+            saved = orjson.loads(f.read())
+        if tuple(saved["stamp"]) == stamp:
+            hashes = saved["hashes"]
+    except (OSError, orjson.JSONDecodeError, KeyError, TypeError):
+        pass
+    if hashes is None:
+        hashes = compute_hashes(load_state(filepath))
+    _hashes_cache[filepath] = (stamp, hashes)
+    return hashes
+
+def update_commune(insee, mutator, default_commune=None, filepath="rne_state.json"):
+    """
+    Lecture-modification-écriture d'une seule commune sous le verrou d'écriture.
+    mutator(commune) reçoit une copie de la commune (ou de default_commune si elle est absente) :
+    l'état partagé en cache n'est jamais modifié en place, et un état sauvegardé entre-temps
+    (synchronisation RNE) n'est pas écrasé par une version périmée.
+    """
+    with _state_write_guard(filepath):
+        state = dict(load_state(filepath))
+        commune = copy.deepcopy(state.get(insee, default_commune or EMPTY_COMMUNE))
+        mutator(commune)
+        state[insee] = commune
+        hashes = dict(load_hashes(filepath))
+        hashes[insee] = commune_hash(commune)
+        save_state(state, filepath, hashes)
+    return commune
+
+def replace_communes(new_state, insee_codes, filepath="rne_state.json"):
+    """
+    Remplace dans l'état sauvegardé les seules communes listées par leur version issue de new_state
+    (une commune absente de new_state est retirée), sous le verrou d'écriture.
+    """
+    with _state_write_guard(filepath):
+        state = dict(load_state(filepath))
+        hashes = dict(load_hashes(filepath))
+        for insee in insee_codes:
+            if insee in new_state:
+                state[insee] = new_state[insee]
+                hashes[insee] = commune_hash(new_state[insee])
+            else:
+                state.pop(insee, None)
+                hashes.pop(insee, None)
+        save_state(state, filepath, hashes)
 
 def load_state(filepath="rne_state.json"):
-    import os
+    """
+    Charge l'état RNE depuis le disque. Le fichier n'est relu que si sa date
+    de modification ou sa taille ont changé depuis le dernier chargement.
+    L'objet retourné est partagé entre les appelants : ne pas le modifier en place.
+    """
     if not os.path.exists(filepath):
         return {}
-    with open(filepath, "r", encoding="utf-8") as f:
-        return json.load(f)
+    stamp = _file_stamp(filepath)
+    cached = _state_cache.get(filepath)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    with open(filepath, "rb") as f:
+        state = orjson.loads(f.read())
+    _state_cache[filepath] = (stamp, state)
+    return state
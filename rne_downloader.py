@@ -1,11 +1,20 @@
 import os
+import json
+import shutil
 import requests
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 RNE_API_URL = "https://www.data.gouv.fr/api/1/datasets/5c34c4d1634f4173183a64f1/"
 
+# Session HTTP partagée : la connexion TCP/TLS vers data.gouv.fr est réutilisée d'un appel à l'autre.
+# Elle annonce déjà la compression (Accept-Encoding: gzip, deflate, plus br si brotli est installé) :
+# on ne force pas l'en-tête, car un encodage annoncé mais non décodable par urllib3
+# finirait tel quel dans les CSV (download_file décode via decode_content).
+SESSION = requests.Session()
+
 TARGET_FILES = [
     "elus-maires-mai.csv",
     "elus-conseillers-municipaux-cm.csv",
@@ -13,11 +22,18 @@ TARGET_FILES = [
     "elus-conseillers-communautaires-epci.csv"
 ]
 
+# Téléchargements simultanés (un par fichier RNE) : le temps total est celui du plus lent, pas la somme
+MAX_DOWNLOAD_WORKERS = 4
+# Taille des blocs copiés du réseau vers le disque
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+# Validateurs HTTP (ETag / Last-Modified) des derniers téléchargements, par URL, dans le dossier des CSV
+ETAGS_FILENAME = "etags.json"
+
 def get_latest_download_links():
     """Retrieve the latest URLs for the RNE CSV files from data.gouv.fr API."""
     logging.info("Fetching latest links from RNE API...")
     try:
-        response = requests.get(RNE_API_URL, timeout=10)
+        response = SESSION.get(RNE_API_URL, timeout=10)
         response.raise_for_status()
         data = response.json()
     except Exception as e:
@@ -31,19 +47,55 @@ def get_latest_download_links():
                 links[target] = res['url']
     return links
 
-def download_file(url, dest_path):
-    """Download a large file streaming via HTTP."""
+def load_etags(download_dir):
+    """Load the {url: [etag, last_modified]} validators saved by the previous run."""
+    try:
+        with open(os.path.join(download_dir, ETAGS_FILENAME), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_etags(etags, download_dir):
+    with open(os.path.join(download_dir, ETAGS_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(etags, f, indent=2)
+
+def download_file(url, dest_path, session=SESSION, etags=None):
+    """
+    Download a large file streaming via HTTP.
+    With an etags dict, the GET is conditional (If-None-Match / If-Modified-Since): on a
+    304 the local file is kept as is, and after a 200 the new validators are stored in etags[url].
+    """
     logging.info(f"Downloading {url} to {dest_path}...")
+    headers = {}
+    # Requête conditionnelle seulement si le fichier local correspondant existe encore
+    if etags is not None and url in etags and os.path.exists(dest_path):
+        etag, last_modified = etags[url]
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    tmp_path = f"{dest_path}.part"
     try:
-        with requests.get(url, stream=True, timeout=20) as r:
+        with session.get(url, stream=True, timeout=20, headers=headers) as r:
+            if r.status_code == 304:
+                logging.info(f"{dest_path} is up to date (304 Not Modified)")
+                return True
             r.raise_for_status()
-            with open(dest_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            # Copie par blocs de 1 Mo directement depuis le flux urllib3 (gzip éventuel décodé au passage).
+            # Écriture dans un fichier temporaire : un téléchargement interrompu ne remplace pas le CSV
+            # précédent, dont les validateurs restent donc valables.
+            r.raw.decode_content = True
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(r.raw, f, length=DOWNLOAD_BUFFER_SIZE)
+            os.replace(tmp_path, dest_path)
+            if etags is not None:
+                etags[url] = [r.headers.get('ETag'), r.headers.get('Last-Modified')]
         logging.info(f"Successfully downloaded {dest_path}")
         return True
     except Exception as e:
         logging.error(f"Error downloading {url}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         return False
 
 def download_all_rne_datasets(download_dir="data_rne"):
@@ -52,13 +104,23 @@ def download_all_rne_datasets(download_dir="data_rne"):
         os.makedirs(download_dir)
         
     links = get_latest_download_links()
-    success = True
-    for target, url in links.items():
-        dest = os.path.join(download_dir, target)
-        if not download_file(url, dest):
-            success = False
-            
-    return success
+    if not links:
+        return True
+
+    # Chaque thread ne met à jour que l'entrée de son URL ; le fichier est écrit une seule fois, ici
+    etags = load_etags(download_dir)
+
+    # Les threads partagent SESSION : son pool urllib3 garde les connexions vers data.gouv.fr ouvertes
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        futures = [
+            executor.submit(download_file, url, os.path.join(download_dir, target), etags=etags)
+            for target, url in links.items()
+        ]
+        # Chaque téléchargement va à son terme, même si un autre a échoué
+        results = [f.result() for f in futures]
+
+    save_etags(etags, download_dir)
+    return all(results)
 
 if __name__ == "__main__":
     download_all_rne_datasets()
@@ -1,106 +1,304 @@
 import os
+import gc
 import csv
-import json
 import logging
+from contextlib import contextmanager
+from dataclasses import dataclass
+from itertools import repeat
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def process_file(filepath, default_poste, state):
+try:
+    import pandas as pd
+except ImportError:
+    logging.warning("pandas n'est pas installé : lecture des CSV RNE avec le module csv standard (plus lent).")
+    pd = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pacsv
+except ImportError:
+    pa = pc = pacsv = None
+
+# Nombre de lignes CSV traitées par bloc (voir process_file)
+CSV_CHUNK_SIZE = 256_000
+# Taille (en octets) des blocs lus par le lecteur CSV de pyarrow
+ARROW_BLOCK_SIZE = 32 * 1024 * 1024
+
+# Mapping des colonnes (elles peuvent légèrement varier) : nom logique -> en-têtes possibles, par ordre de préférence.
+# L'ordre des clés est celui des tuples de colonnes manipulés par le parsing.
+COLUMN_ALIASES = {
+    "insee": ("Code de la commune", "Code de la commune ou de l'arrondissement"),
+    "nom_commune": ("Libellé de la commune", "Libellé de la commune ou de l'arrondissement"),
+    "nom": ("Nom de l'élu",),
+    "prenom": ("Prénom de l'élu",),
+    "dob": ("Date de naissance",),
+    "fonction": ("Libellé de la fonction",),
+}
+REQUIRED_COLUMNS = ("insee", "nom", "prenom")
+
+def resolve_columns(fieldnames):
+    """
+    Associe chaque nom logique de COLUMN_ALIASES à l'en-tête réel du fichier (None si absent).
+    """
+    # Pour une compatibilité robuste, on nettoie les espaces autour des noms de colonnes
+    stripped = {k.strip(): k for k in fieldnames}
+    return {
+        logical: next((stripped[c] for c in candidates if c in stripped), None)
+        for logical, candidates in COLUMN_ALIASES.items()
+    }
+
+@dataclass(slots=True)
+class Elu:
+    """
+    Élu en cours de parsing : __slots__ au lieu d'un dict par élu (centaines de milliers d'objets).
+    Converti en dict {"nom", "prenom", "postes"} à la fin du parsing (format de l'état).
+    """
+    nom: str
+    prenom: str
+    # dict utilisé comme ensemble ordonné : dédoublonnage en O(1), ordre d'apparition conservé
+    postes: dict
+
+def process_file(filepath, default_poste, state, pool=None):
     """
     Lit un fichier CSV du RNE et met à jour l'état.
+    pool : table de dédoublonnage des chaînes, partagée entre les fichiers d'un même parsing (voir _merge_rows).
     """
+    if pool is None:
+        pool = {}
     if not os.path.exists(filepath):
         logging.warning(f"Fichier introuvable: {filepath}")
         return
 
     logging.info(f"Analyse de {filepath}...")
-    with open(filepath, mode='r', encoding='utf-8') as f:
+    # Seule la ligne d'en-tête est lue ici, pour résoudre les noms de colonnes
+    with open(filepath, mode='r', encoding='utf-8', newline='') as f:
         # Les fichiers utilisent le point-virgule
-        reader = csv.DictReader(f, delimiter=';')
-        
-        # Pour une compatibilité robuste, on nettoie les espaces autour des noms de colonnes
-        header = {k.strip(): k for k in reader.fieldnames}
+        fieldnames = next(csv.reader(f, delimiter=';'), [])
         
-        # Mapping des colonnes (elles peuvent légèrement varier)
-        col_insee = header.get("Code de la commune") or header.get("Code de la commune ou de l'arrondissement")
-        col_nom_commune = header.get("Libellé de la commune") or header.get("Libellé de la commune ou de l'arrondissement")
-        col_nom = header.get("Nom de l'élu")
-        col_prenom = header.get("Prénom de l'élu")
-        col_dob = header.get("Date de naissance")
-        col_fonction = header.get("Libellé de la fonction")
-
-        if not all([col_insee, col_nom, col_prenom]):
-            logging.error(f"Colonnes essentielles manquantes dans {filepath}. Header: {reader.fieldnames}")
-            return
+    resolved = resolve_columns(fieldnames)
+    missing = [logical for logical in REQUIRED_COLUMNS if not resolved[logical]]
+    if missing:
+        logging.error(f"Colonnes essentielles manquantes dans {filepath} ({', '.join(missing)}). Header: {fieldnames}")
+        return
+
+    columns = tuple(resolved.values())
+    usecols = [c for c in columns if c]
+    if pacsv is not None:
+        # Lecteur CSV de pyarrow (multithreadé, validation UTF-8 vectorisée), en flux par blocs d'octets.
+        # Toutes les colonnes restent en texte ; les cellules vides donnent "" et non null.
+        reader = pacsv.open_csv(
+            filepath,
+            read_options=pacsv.ReadOptions(block_size=ARROW_BLOCK_SIZE),
+            parse_options=pacsv.ParseOptions(delimiter=';'),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=usecols,
+                column_types={c: pa.string() for c in usecols},
+            ),
+        )
+        with reader:
+            for batch in reader:
+                _merge_rows(_arrow_rows(batch, columns, default_poste), state, pool)
+        return
+
+    if pd is None:
+        _merge_rows(_csv_rows(filepath, fieldnames, columns, default_poste), state, pool)
+        return
+
+    # Parseur C de pandas : seules les colonnes utiles sont lues, toutes en texte, sans conversion NaN.
+    # Lecture par blocs : la mémoire du parsing est bornée par CSV_CHUNK_SIZE lignes, pas par la taille du fichier.
+    reader = pd.read_csv(
+        filepath, sep=';', dtype=str, usecols=usecols, na_filter=False,
+        engine='c', encoding='utf-8', chunksize=CSV_CHUNK_SIZE
+    )
+    with reader:
+        for chunk in reader:
+            _merge_rows(_chunk_rows(chunk, columns, default_poste), state, pool)
+
+def _csv_rows(filepath, fieldnames, columns, default_poste):
+    """
+    Repli sans pandas : csv.reader (pas de dict par ligne comme DictReader),
+    les champs sont lus par position, indices calculés une seule fois.
+    """
+    col_insee, col_nom_commune, col_nom, col_prenom, col_dob, col_fonction = columns
+    idx_insee = fieldnames.index(col_insee)
+    idx_nom = fieldnames.index(col_nom)
+    idx_prenom = fieldnames.index(col_prenom)
+    idx_nom_commune = fieldnames.index(col_nom_commune) if col_nom_commune else None
+    idx_dob = fieldnames.index(col_dob) if col_dob else None
+    idx_fonction = fieldnames.index(col_fonction) if col_fonction else None
+    width = max(i for i in (idx_insee, idx_nom, idx_prenom, idx_nom_commune, idx_dob, idx_fonction) if i is not None) + 1
 
+    with open(filepath, mode='r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f, delimiter=';')
+        next(reader, None)
         for row in reader:
-            insee = row.get(col_insee, "").strip()
-            nom_commune = row.get(col_nom_commune, "").strip()
-            nom = row.get(col_nom, "").strip().upper()
-            prenom = row.get(col_prenom, "").strip()
-            dob = row.get(col_dob, "").strip()
-            
-            # Gestion de la fonction / poste
-            poste = row.get(col_fonction, "").strip() if col_fonction else ""
-            if not poste:
-                poste = default_poste
-
-            if not insee or not nom:
+            # Lignes vides ou tronquées
+            if len(row) < width:
                 continue
+            # Les codes, libellés et dates du RNE sont propres : seuls nom et prénom sont nettoyés
+            yield (
+                row[idx_insee],
+                row[idx_nom_commune] if idx_nom_commune is not None else "",
+                row[idx_nom].strip().upper(),
+                row[idx_prenom].strip(),
+                row[idx_dob] if idx_dob is not None else "",
+                (row[idx_fonction] if idx_fonction is not None else "") or default_poste,
+            )
 
-            # Création de la clé unique
-            elu_key = f"{nom}|{prenom}|{dob}"
+def _arrow_rows(batch, columns, default_poste):
+    """
+    Nettoie un bloc lu par pyarrow avec les noyaux de pyarrow.compute (strip/upper en C
+    sur toute la colonne) ; Python ne fait plus qu'itérer sur les valeurs déjà propres.
+    """
+    col_insee, col_nom_commune, col_nom, col_prenom, col_dob, col_fonction = columns
+
+    def clean(col):
+        return pc.utf8_trim_whitespace(batch.column(col)) if col else None
 
-            if insee not in state:
-                state[insee] = {
-                    "nom_commune": nom_commune,
+    def values(array):
+        if array is None:
+            return repeat("")
+        if pd is not None:
+            # to_pandas() partage les chaînes identiques (deduplicate_objects) : moins d'objets str créés
+            return array.to_pandas().tolist()
+        return array.to_numpy(zero_copy_only=False)
+
+    # Gestion de la fonction / poste
+    poste = clean(col_fonction)
+    postes = values(pc.if_else(pc.equal(poste, ""), default_poste, poste)) if poste is not None else repeat(default_poste)
+
+    return zip(
+        values(clean(col_insee)),
+        values(clean(col_nom_commune)),
+        values(pc.utf8_upper(clean(col_nom))),
+        values(clean(col_prenom)),
+        values(clean(col_dob)),
+        postes,
+    )
+
+def _chunk_rows(df, columns, default_poste):
+    """Nettoie un bloc de lignes CSV lu par pandas et renvoie ses lignes sous forme de tuples."""
+    col_insee, col_nom_commune, col_nom, col_prenom, col_dob, col_fonction = columns
+
+    # Nettoyage vectorisé (au lieu de .strip()/.upper() cellule par cellule)
+    def clean(col):
+        return df[col].str.strip() if col else ""
+
+    poste = clean(col_fonction)
+    rows = pd.DataFrame({
+        "insee": clean(col_insee),
+        "nom_commune": clean(col_nom_commune),
+        "nom": df[col_nom].str.strip().str.upper(),
+        "prenom": clean(col_prenom),
+        "dob": clean(col_dob),
+        # Gestion de la fonction / poste
+        "poste": poste.mask(poste == "", default_poste) if col_fonction else default_poste,
+    })
+    return rows.itertuples(index=False, name=None)
+
+def _merge_rows(rows, state, pool):
+    """
+    Intègre à l'état des lignes nettoyées (insee, nom_commune, nom, prenom, dob, poste).
+    pool dédoublonne les chaînes répétées (noms, prénoms, postes, communes) : toutes les occurrences
+    identiques pointent vers un seul objet str. Indispensable pour le repli csv.reader, qui crée un
+    objet par cellule ; pandas/pyarrow partagent déjà les doublons au sein d'un bloc.
+    """
+    intern = pool.setdefault
+    # Les lignes d'une même commune se suivent dans les fichiers RNE : la table des élus de la
+    # commune courante est gardée sous la main, une seule recherche par ligne (l'élu) au lieu de
+    # state[insee]["elus"][elu_key] répété.
+    current_insee = None
+    commune_elus = None
+    for insee, nom_commune, nom, prenom, dob, poste in rows:
+        if not insee or not nom:
+            continue
+        # upper() renvoie une copie par ligne : on replie les noms identiques
+        nom = intern(nom, nom)
+
+        if insee != current_insee:
+            commune = state.get(insee)
+            if commune is None:
+                commune = state[insee] = {
+                    "nom_commune": intern(nom_commune, nom_commune),
                     "elus": {}
                 }
+            commune_elus = commune["elus"]
+            current_insee = insee
 
-            if elu_key not in state[insee]["elus"]:
-                state[insee]["elus"][elu_key] = {
-                    "nom": nom,
-                    "prenom": prenom,
-                    "postes": []
-                }
+        # Création de la clé unique
+        elu_key = f"{nom}|{prenom}|{dob}"
 
-            if poste not in state[insee]["elus"][elu_key]["postes"]:
-                state[insee]["elus"][elu_key]["postes"].append(poste)
+        poste = intern(poste, poste)
+        elu = commune_elus.get(elu_key)
+        if elu is None:
+            commune_elus[elu_key] = Elu(nom, intern(prenom, prenom), {poste: None})
+        else:
+            elu.postes[poste] = None
+
+@contextmanager
+def _gc_paused():
+    """Désactive le ramasse-miettes cyclique pendant le bloc (s'il était actif)."""
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
 
 def parse_all_rne_datasets(data_dir="data_rne"):
     """
     Parse les fichiers RNE locaux et retourne un dictionnaire agrégé.
     """
     state = {}
+    # Table de dédoublonnage des chaînes, propre à ce parsing : libérée avec lui
+    # (le processus de l'API, qui lance les synchronisations, vit longtemps)
+    pool = {}
     
-    # 1. Conseillers Municipaux
-    # On ajoute un default poste si par hasard la colonne fonction est vide
-    process_file(
-        os.path.join(data_dir, "elus-conseillers-municipaux-cm.csv"),
-        default_poste="Conseiller municipal",
-        state=state
-    )
+    # L'état compte des centaines de milliers de petits dicts/listes qui survivent tous au parsing :
+    # le ramasse-miettes cyclique les reparcourt sans rien pouvoir libérer, on le suspend le temps du parsing.
+    with _gc_paused():
+        # 1. Conseillers Municipaux
+        # On ajoute un default poste si par hasard la colonne fonction est vide
+        process_file(
+            os.path.join(data_dir, "elus-conseillers-municipaux-cm.csv"),
+            default_poste="Conseiller municipal",
+            state=state,
+            pool=pool
+        )
 
-    # 2. Maires (souvent sans colonne "fonction", donc on force "Maire")
-    process_file(
-        os.path.join(data_dir, "elus-maires-mai.csv"),
-        default_poste="Maire",
-        state=state
-    )
+        # 2. Maires (souvent sans colonne "fonction", donc on force "Maire")
+        process_file(
+            os.path.join(data_dir, "elus-maires-mai.csv"),
+            default_poste="Maire",
+            state=state,
+            pool=pool
+        )
 
-    # 3. Arrondissements
-    process_file(
-        os.path.join(data_dir, "elus-conseillers-darrondissements-ca.csv"),
-        default_poste="Conseiller d'arrondissement",
-        state=state
-    )
-    
-    # 4. Communautaires (EPCI) - Optionnel si l'on veut un scope agglomération
-    # process_file(
-    #     os.path.join(data_dir, "elus-conseillers-communautaires-epci.csv"),
-    #     default_poste="Conseiller communautaire",
-    #     state=state
-    # )
+        # 3. Arrondissements
+        process_file(
+            os.path.join(data_dir, "elus-conseillers-darrondissements-ca.csv"),
+            default_poste="Conseiller d'arrondissement",
+            state=state,
+            pool=pool
+        )
+
+        # 4. Communautaires (EPCI) - Optionnel si l'on veut un scope agglomération
+        # process_file(
+        #     os.path.join(data_dir, "elus-conseillers-communautaires-epci.csv"),
+        #     default_poste="Conseiller communautaire",
+        #     state=state,
+        #     pool=pool
+        # )
+
+        # Les élus repassent en dicts, postes en listes (format de l'état sérialisé et du webhook)
+        for commune in state.values():
+            commune["elus"] = {
+                elu_key: {"nom": elu.nom, "prenom": elu.prenom, "postes": list(elu.postes)}
+                for elu_key, elu in commune["elus"].items()
+            }
 
     logging.info(f"Parsing terminé. Communes trouvées : {len(state)}")
     return state
@@ -12,9 +12,11 @@ Mairies supportées :
 
 import os
 import requests
-from bs4 import BeautifulSoup
+import orjson
+from bs4 import BeautifulSoup, SoupStrainer
 import re
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # --- CONFIGURATION ---
 WEBHOOK_URL = "https://n8n.media-start.fr/webhook/a14f3c73-e1ce-4700-8113-7ab035a9ae16"
@@ -22,14 +24,31 @@ HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
 }
 
+# Session HTTP partagée : les connexions (TCP + TLS) vers un même site sont réutilisées d'une page à l'autre
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+
+# Parseur HTML : lxml (C) s'il est installé, sinon le parseur pur Python de la stdlib
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# Nombre de pages téléchargées en parallèle (Lyon : 2 pages centrales + 9 arrondissements)
+MAX_FETCH_WORKERS = 10
+
+# Regex compilées une seule fois au chargement du module
+_WS_RE = re.compile(r'\s+')
+_MAIRE_RE = re.compile(r"Monsieur le Maire", re.I)
+# Liens Lyon qui ne sont pas des élus (recherche de sous-chaîne : "Mairies d'arrondissement", etc.)
+_EXCLUDE_RE = re.compile(r"Le Maire|trombinoscope|Mairies")
+
 def clean_text(text):
     """Nettoie les espaces, sauts de ligne et caractères spéciaux."""
     if not text: return ""
-    # Remplace les sauts de ligne et tabulations par des espaces
-    text = text.replace('\r', ' ').replace('\n', ' ').replace('\t', ' ')
-    # Supprime les espaces multiples
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip()
+    # Une seule passe : \s couvre déjà sauts de ligne et tabulations, remplacés avec les espaces multiples
+    return _WS_RE.sub(' ', text).strip()
 
 def parse_name_simple(full_name):
     """Sépare le prénom du nom. Hypothèse : dernier mot = Nom."""
@@ -45,6 +64,10 @@ def parse_name_simple(full_name):
         return prenom, nom
     return " ".join(parts[:-1]), parts[-1]
 
+def name_key(prenom, nom):
+    """Clé de dédoublonnage d'un élu, insensible à la casse."""
+    return (nom.upper(), prenom.lower())
+
 def parse_name_by_case(full_name):
     """Sépare le prénom du nom en utilisant la casse (MAJUSCULES pour le nom)."""
     full_name = clean_text(full_name)
@@ -58,17 +81,32 @@ def parse_name_by_case(full_name):
         return " ".join(parts[:-1]), parts[-1]
     return " ".join(prenom_parts), " ".join(nom_parts)
 
+# Sous-arbres réellement exploités par chaque scraper : le reste de la page n'est pas construit
+TOULOUSE_STRAINER = SoupStrainer('article', class_='elect__list')
+LYON_CENTRAL_STRAINER = SoupStrainer('li')
+LYON_ARRDT_STRAINER = SoupStrainer(['h1', 'a'])
+
+def fetch_soup(url, parse_only=None):
+    """
+    Télécharge une page et renvoie son arbre BeautifulSoup.
+    parse_only (SoupStrainer) limite l'arbre aux balises utiles.
+    """
+    response = SESSION.get(url, timeout=15)
+    if HTML_PARSER == 'lxml':
+        # lxml reçoit les octets bruts et détecte lui-même l'encodage (pas de copie décodée)
+        return BeautifulSoup(response.content, HTML_PARSER, parse_only=parse_only)
+    return BeautifulSoup(response.text, HTML_PARSER, parse_only=parse_only)
+
 def scrape_gignac():
     """Scraping spécifique pour Gignac-la-Nerthe."""
     url = "https://www.gignaclanerthe.fr/notre-mairie/le-maire-et-les-elus/"
     data = []
     try:
-        response = requests.get(url, headers=HEADERS, timeout=15)
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = fetch_soup(url)
         date_today = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
 
         # Maire
-        maire_tag = soup.find('p', string=re.compile(r"Monsieur le Maire", re.I))
+        maire_tag = soup.find('p', string=_MAIRE_RE)
         if maire_tag:
             p, n = parse_name_by_case(maire_tag.get_text())
             data.append({"prenom": p, "nom": n, "poste": "Maire", "date_scraping": date_today, "source": url})
@@ -90,8 +128,7 @@ def scrape_toulouse():
     url = "https://metropole.toulouse.fr/elus-au-conseil-municipal"
     data = []
     try:
-        response = requests.get(url, headers=HEADERS, timeout=15)
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = fetch_soup(url, parse_only=TOULOUSE_STRAINER)
         date_today = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
 
         articles = soup.find_all('article', class_='elect__list')
@@ -128,6 +165,7 @@ def scrape_lyon():
         "Mairie centrale": []
     }
     date_today = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    # Élus déjà ajoutés, par clé (NOM, prénom) : un élu présent sur plusieurs pages n'est gardé qu'une fois
     added_names = set()
     
     # 1. Mairie Centrale (Adjoints et Conseillers)
@@ -136,11 +174,19 @@ def scrape_lyon():
         "https://www.lyon.fr/actions-et-projets/le-maire-et-les-elus/les-conseilleres-et-conseillers-municipaux"
     ]
     
+    arrdt_urls = [f"https://www.lyon.fr/actions-et-projets/les-conseils-d-arrondissement/ca/{i}" for i in range(1, 10)]
+
+    # Les 11 pages sont téléchargées en parallèle dès maintenant ; l'analyse (et le dédoublonnage
+    # via added_names) reste séquentielle sur ce thread, dans l'ordre habituel.
+    executor = ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS)
+    pages = {url: executor.submit(fetch_soup, url, LYON_CENTRAL_STRAINER) for url in central_urls}
+    pages.update({url: executor.submit(fetch_soup, url, LYON_ARRDT_STRAINER) for url in arrdt_urls})
+    executor.shutdown(wait=False)
+
     for url in central_urls:
         print(f"Scraping Lyon Centrale ({url.split('/')[-1]})...")
         try:
-            response = requests.get(url, headers=HEADERS, timeout=15)
-            soup = BeautifulSoup(response.text, 'html.parser')
+            soup = pages[url].result()
             
             for li in soup.find_all('li'):
                 a_tag = li.find('a', href=True)
@@ -149,11 +195,11 @@ def scrape_lyon():
                 strong = a_tag.find('strong')
                 full_name = clean_text(strong.get_text() if strong else a_tag.get_text())
                 
-                if len(full_name) < 4 or any(x in full_name for x in ["Le Maire", "trombinoscope", "Mairies"]): continue
-                if full_name in added_names: continue
-                added_names.add(full_name)
-
+                if len(full_name) < 4 or _EXCLUDE_RE.search(full_name): continue
                 p, n = parse_name_simple(full_name)
+                name = name_key(p, n)
+                if name in added_names: continue
+                added_names.add(name)
                 
                 li_text = li.get_text(separator='|', strip=True)
                 parts = [clean_text(pt) for pt in li_text.split('|') if pt.strip()]
@@ -179,23 +225,22 @@ def scrape_lyon():
             print(f"Erreur Lyon Centrale ({url}): {e}")
 
     # 2. Arrondissements (live URLs)
-    for i in range(1, 10):
+    for i, url in enumerate(arrdt_urls, start=1):
         key = f"{i}er arrondissement" if i == 1 else f"{i}e arrondissement"
         data[key] = []
-        url = f"https://www.lyon.fr/actions-et-projets/les-conseils-d-arrondissement/ca/{i}"
         print(f"Scraping Lyon Arrdt {i}...")
         try:
-            response = requests.get(url, headers=HEADERS, timeout=15)
-            soup = BeautifulSoup(response.text, 'html.parser')
+            soup = pages[url].result()
             
             # Maire (H1)
             h1s = soup.find_all('h1')
             for h1 in h1s:
                 full_text = clean_text(h1.get_text())
                 if "Conseil du" in full_text or len(full_text) < 4: continue
-                if full_text in added_names: continue
-                added_names.add(full_text)
                 p, n = parse_name_simple(full_text)
+                name = name_key(p, n)
+                if name in added_names: continue
+                added_names.add(name)
                 data[key].append({
                     "prenom": p, "nom": n, 
                     "poste": f"Maire du {i}er arrondissement" if i==1 else f"Maire du {i}e arrondissement", 
@@ -211,11 +256,11 @@ def scrape_lyon():
                 if not parts: continue
                 
                 full_name = parts[0]
-                if len(full_name) < 4 or any(x in full_name for x in ["Le Maire", "trombinoscope", "Mairies"]): continue
-                if full_name in added_names: continue
-                added_names.add(full_name)
-                
+                if len(full_name) < 4 or _EXCLUDE_RE.search(full_name): continue
                 p, n = parse_name_simple(full_name)
+                name = name_key(p, n)
+                if name in added_names: continue
+                added_names.add(name)
                 
                 poste_parts = []
                 for pt in parts[1:]:
@@ -248,7 +293,10 @@ def send_to_webhook(data):
                 total_count += len(city_data)
                 
         print(f"Envoi de {total_count} élus au webhook (regroupés par ville)...")
-        response = requests.post(WEBHOOK_URL, json=data, timeout=20)
+        response = SESSION.post(
+            WEBHOOK_URL, data=orjson.dumps(data),
+            headers={"Content-Type": "application/json"}, timeout=20
+        )
         response.raise_for_status()
         print(f"Succès ! Code : {response.status_code}")
     except Exception as e:
@@ -1,15 +1,48 @@
 import os
 import time
+import random
 import logging
 import requests
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from rne_downloader import download_all_rne_datasets
 from rne_parser import parse_all_rne_datasets
-from rne_differ import compute_diff, load_state, save_state
+from rne_differ import compute_diff, compute_hashes, load_hashes, load_state, save_state, replace_communes
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 WEBHOOK_URL = "https://n8n.media-start.fr/webhook/a14f3c73-e1ce-4700-8113-7ab035a9ae16"
 
+# Corps des requêtes webhook sérialisés par orjson (bytes, bien plus rapide que le json de requests)
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Nombre maximal de lots envoyés simultanément à n8n
+WEBHOOK_MAX_IN_FLIGHT = 4
+# Nouvelles tentatives d'un lot refusé par n8n avec un 429 (Too Many Requests)
+WEBHOOK_MAX_RETRIES = 5
+
+def _post_chunk(session, chunk, chunk_index, total_chunks):
+    """
+    Envoie un lot au webhook. Sur un 429, on réessaie après Retry-After s'il est fourni,
+    sinon après un délai exponentiel aléatoire (pour que les lots ne repartent pas ensemble).
+    """
+    try:
+        logging.info(f"Envoi du lot {chunk_index}/{total_chunks} ({len(chunk)} communes)...")
+        payload = orjson.dumps({"rne_updates": chunk})
+        for attempt in range(WEBHOOK_MAX_RETRIES + 1):
+            response = session.post(WEBHOOK_URL, data=payload, headers=JSON_HEADERS, timeout=30)
+            if response.status_code != 429 or attempt == WEBHOOK_MAX_RETRIES:
+                break
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else random.uniform(0, 2 ** attempt)
+            logging.warning(f"Lot {chunk_index} limité par n8n (429), nouvel essai dans {delay:.1f}s...")
+            time.sleep(delay)
+        response.raise_for_status()
+        return True
+    except Exception as e:
+        logging.error(f"Erreur lors de l'envoi au webhook pour le lot {chunk_index}: {e}")
+        return False
+
 def send_to_webhook(diff_report):
     """
     Envoie les données (le diff) au webhook n8n par lots (chunks) 
@@ -24,23 +57,15 @@ def send_to_webhook(diff_report):
     
     logging.info(f"Envoi de {len(diff_report)} communes modifiées au webhook ({total_chunks} lots)...")
     
-    success_all = True
-    
-    for i in range(0, len(diff_report), CHUNK_SIZE):
-        chunk = diff_report[i:i + CHUNK_SIZE]
-        chunk_index = (i // CHUNK_SIZE) + 1
-        
-        try:
-            logging.info(f"Envoi du lot {chunk_index}/{total_chunks} ({len(chunk)} communes)...")
-            response = requests.post(WEBHOOK_URL, json={"rne_updates": chunk}, timeout=30)
-            response.raise_for_status()
-            
-            # Petite pause pour ne pas surcharger n8n
-            time.sleep(2)
-        except Exception as e:
-            logging.error(f"Erreur lors de l'envoi au webhook pour le lot {chunk_index}: {e}")
-            success_all = False
-            # On continue d'envoyer les autres lots même si l'un échoue
+    # Lots envoyés en parallèle (au plus WEBHOOK_MAX_IN_FLIGHT à la fois) sur une même session keep-alive.
+    # Pas de pause fixe entre les lots : si n8n sature, il répond 429 et _post_chunk temporise.
+    # On continue d'envoyer les autres lots même si l'un échoue.
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=WEBHOOK_MAX_IN_FLIGHT) as executor:
+        futures = [
+            executor.submit(_post_chunk, session, diff_report[i:i + CHUNK_SIZE], (i // CHUNK_SIZE) + 1, total_chunks)
+            for i in range(0, len(diff_report), CHUNK_SIZE)
+        ]
+        success_all = all([f.result() for f in futures])
             
     if success_all:
         logging.info("Succès complet des envois Webhook !")
@@ -49,7 +74,15 @@ def send_to_webhook(diff_report):
         
     return success_all
 
-def main():
+def main(insee_filter=None):
+    """
+    Synchronisation RNE complète, ou restreinte aux codes INSEE de insee_filter
+    (seules ces communes sont alors comparées, envoyées et mises à jour dans l'état).
+    """
+    if insee_filter is not None and not insee_filter:
+        logging.info("Aucun code INSEE à synchroniser.")
+        return
+
     logging.info("Démarrage de la synchronisation RNE...")
     
     # 1. Télécharger (commentez la ligne si vous lancez plusieurs fois pour gagner du temps)
@@ -64,9 +97,14 @@ def main():
     old_state = load_state()
     is_first_run = len(old_state) == 0
     
-    # 4. Calculer le diff (Plus de filtre, on vérifie les ~35000 communes)
+    # 4. Calculer le diff (sans filtre, on vérifie les ~35000 communes)
     logging.info("Calcul des différences...")
-    diff_report = compute_diff(old_state, new_state, insee_filter=None)
+    # Les empreintes par commune évitent de parcourir les élus des communes inchangées
+    new_hashes = compute_hashes(new_state)
+    diff_report = compute_diff(
+        old_state, new_state, insee_filter=insee_filter,
+        old_hashes=load_hashes(), new_hashes=new_hashes
+    )
     
     if not diff_report:
         logging.info("Aucun changement détecté.")
@@ -85,8 +123,12 @@ def main():
     
     # 6. Mettre à jour et sauvegarder si l'envoi réussit
     if success:
-        logging.info("Sauvegarde du nouvel état RNE global...")
-        save_state(new_state)
+        if insee_filter and not is_first_run:
+            logging.info(f"Sauvegarde des {len(insee_filter)} commune(s) synchronisée(s)...")
+            replace_communes(new_state, insee_filter)
+        else:
+            logging.info("Sauvegarde du nouvel état RNE global...")
+            save_state(new_state, hashes=new_hashes)
         logging.info("Sauvegarde terminée.")
     else:
         logging.warning("L'état n'a pas été sauvegardé à cause d'erreurs d'envoi. La prochaine exécution retentera l'envoi complet.")